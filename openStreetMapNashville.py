@@ -1,25 +1,44 @@
-import xml.etree.cElementTree as ET
+from collections import Counter
+
+from lxml import etree as ET
 import pprint
 
 dataset = "map.osm"
 
-def count_tags(filename):
-    tag_dict = {}
-    for event, elem in ET.iterparse(filename):
-        if elem.tag not in tag_dict:
-            tag_dict[elem.tag] = 1
-        else:
-            tag_dict[elem.tag] += 1
+def clear_element(elem):
+    """Free a handled element, plus everything before it at its own and every enclosing level"""
+    elem.clear()
+    while elem.getparent() is not None:
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        elem = elem.getparent()
 
-    return tag_dict
+def get_element(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag (tags=None yields every element)"""
 
-print(count_tags(dataset))
+    for _, elem in ET.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        clear_element(elem)
 
-import re
+def count_tags(filename):
+    return Counter(elem.tag for elem in get_element(filename, tags=None))
+
+# Key classification and the problem-character checks are plain character-set
+# membership, so they are done with set/translate scans in C rather than through the regex engine
+_PROBLEM = frozenset('=+/&<>;\'"?%#$@,. \t\r\n')
+_LOWER_TABLE = str.maketrans('', '', 'abcdefghijklmnopqrstuvwxyz_')
 
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+def classify_key(k):
+    """Return the key type of a tag key: lower, lower_colon, problemchars or other"""
+    if not _PROBLEM.isdisjoint(k):
+        return 'problemchars'
+    rest = k.translate(_LOWER_TABLE)  # whatever is not [a-z_]
+    if k and not rest:
+        return 'lower'
+    if rest == ':' and not k.startswith(':') and not k.endswith(':'):
+        return 'lower_colon'
+    return 'other'
 
 
 def key_type(element, keys):
@@ -34,14 +53,7 @@ def key_type(element, keys):
     """
     
     if element.tag == 'tag':
-        if lower.search(element.attrib['k']):
-            keys['lower'] +=1
-        elif lower_colon.search(element.attrib['k']):
-            keys['lower_colon'] += 1
-        elif problemchars.search(element.attrib['k']):
-            keys['problemchars'] += 1
-        else:
-            keys['other'] += 1
+        keys[classify_key(element.attrib['k'])] += 1
     return keys
 
 
@@ -51,33 +63,26 @@ def process_tags(filename):
     Returns a dictionary with the count of different types of keys.
     """
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    for element in get_element(filename, tags='tag'):
+        keys[classify_key(element.attrib['k'])] += 1
 
     return keys
 
-tag_type_dict = process_tags(dataset)
-print (tag_type_dict)
-
 def get_problemkeys(filename):
     problemchars_list = []
-    for _, element in ET.iterparse(filename):
-        if element.tag == 'tag':
-            if problemchars.search(element.attrib['k']):
-                problemchars_list.append(element.attrib['k'])
+    for element in get_element(filename, tags='tag'):
+        k = element.attrib['k']
+        if not _PROBLEM.isdisjoint(k):
+            problemchars_list.append(k)
     return problemchars_list
 
-print(get_problemkeys(dataset))
-
 from collections import defaultdict
 
-street_type_re = re.compile(r'\S+\.?$', re.IGNORECASE)
-street_types = defaultdict(int)
-
 def audit_street_type(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
+    # The street type is the last whitespace-separated word (trailing dot included)
+    parts = street_name.rsplit(None, 1)
+    if parts:
+        street_type = parts[-1]
         street_types[street_type] += 1
 
 def print_sorted_dict(d, expression):
@@ -91,15 +96,14 @@ def is_street_name(elem):
     return (elem.tag == "tag") and (elem.attrib['k'] == "addr:street")
 
 def audit(filename):
-    for event, elem in ET.iterparse(filename):
-        if is_street_name(elem):
-            audit_street_type(street_types, elem.attrib['v'])
+    street_types = defaultdict(int)
+    for elem in get_element(filename, tags='tag'):
+        a = elem.attrib
+        if a.get('k') == "addr:street":
+            audit_street_type(street_types, a['v'])
     print(street_types, "%s: %d")
     return(street_types)
 
-all_types = audit(dataset)
-all_types
-
 expected = ['Artery', 'Alley', 'Avenue', 'Boulevard', 'Broadway', 'Commons', 'Court', 'Drive', 'Lane', 'Park', 'Parkway',
             'Place', 'Road', 'Square', 'Street', 'Terrace', 'Trail', 'Turnpike', 'Wharf',
             'Yard']
@@ -118,27 +122,26 @@ abbr_mapping = { 'Ave': 'Avenue',
                   'N': 'North'
                 }
 
-typo_full_names = {}
-
-def audit_street_name(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
-        if (all_types[street_type] < 20) and (street_type not in expected) and (street_type not in abbr_mapping):
-            if street_type in typo_full_names:
-                typo_full_names[street_type].append(street_name)
-            else:
-                typo_full_names.update({ street_type:[street_name] })
-
-def audit_name(filename):
-    for event, elem in ET.iterparse(filename):
-        if is_street_name(elem):
-            audit_street_name(street_types, elem.attrib['v'])    
+# Typos are judged against the street types expected before the audit;
+# `expected` is extended further down once its results have been reviewed
+typo_expected = list(expected)
+
+def audit_street_name(typo_full_names, street_types, street_name):
+    parts = street_name.rsplit(None, 1)
+    if parts:
+        street_type = parts[-1]
+        if (street_types[street_type] < 20) and (street_type not in typo_expected) and (street_type not in abbr_mapping):
+            typo_full_names[street_type].append(street_name)
+
+def audit_name(filename, street_types):
+    typo_full_names = defaultdict(list)
+    for elem in get_element(filename, tags='tag'):
+        a = elem.attrib
+        if a.get('k') == "addr:street":
+            audit_street_name(typo_full_names, street_types, a['v'])
     # print_sorted_dict(street_types)
     return typo_full_names
 
-audit_name(dataset)
-
 expected.extend(['Alley', 'West', 'East', 'Way'])
 
 typo_mapping = { 'Broadway A': 'Broadway',
@@ -157,29 +160,32 @@ numbers_mapping = {'#118': {'4th Avenue South': 'Suite 118'},
                   }
 
 expected = sorted(expected)
-expected
 
-name_problem_chars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\t\r\n]')
+# Same as _PROBLEM, except that spaces and dots are fine in a street name
+_NAME_PROBLEM = frozenset('=+/&<>;\'"?%#$@,\t\r\n')
 
 def get_problem_names(filename):
     problemchars_list = []
-    for _, element in ET.iterparse(filename):
-        if is_street_name(element):
-            if name_problem_chars.search(element.attrib['v']):
-                problemchars_list.append(element.attrib['v'])
+    for element in get_element(filename, tags='tag'):
+        a = element.attrib
+        if a.get('k') == "addr:street" and not _NAME_PROBLEM.isdisjoint(a['v']):
+            problemchars_list.append(a['v'])
     return problemchars_list
 
-print(get_problem_names(dataset))
-problemchars_list = []
-
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
 import csv
-import codecs
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import sqlite3
+from collections import deque
+from contextlib import ExitStack
+from sys import intern
+
+from lxml import etree as ET
 
 import cerberus
 
@@ -192,6 +198,8 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+# Write buffer for the csv(s); large so rows go out in few write() calls
+CSV_BUFFERING = 1024 * 1024
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -205,170 +213,21 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
-def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
-
-    if element.tag == 'node':
-        node_attribs['id'] = element.attrib['id']
-        node_attribs['user'] = element.attrib['user']
-        node_attribs['uid'] = element.attrib['uid']
-        node_attribs['version'] = element.attrib['version']
-        node_attribs['lat'] = element.attrib['lat']
-        node_attribs['lon'] = element.attrib['lon']
-        node_attribs['timestamp'] = element.attrib['timestamp']
-        node_attribs['changeset'] = element.attrib['changeset']
-        
-        for node in element:
-            tag_dict = {}
-            tag_dict['id'] = element.attrib['id']
-            if ':' in node.attrib['k']:
-                tag_dict['type'] = node.attrib['k'].split(':', 1)[0]
-                tag_dict['key'] = node.attrib['k'].split(':', 1)[-1]
-                tag_dict['value'] = node.attrib['v'].split(':', 1)[0]
-            else:
-                tag_dict['type'] = 'regular'
-                tag_dict['key'] = node.attrib['k']
-                tag_dict['value'] = node.attrib['v']
-            tags.append(tag_dict)
-            
-    elif element.tag == 'way':
-        way_attribs['id'] = element.attrib['id']
-        way_attribs['user'] = element.attrib['user']
-        way_attribs['uid'] = element.attrib['uid']
-        way_attribs['version'] = element.attrib['version']
-        way_attribs['timestamp'] = element.attrib['timestamp']
-        way_attribs['changeset'] = element.attrib['changeset']
-        n = 0
-        for node in element:
-            if node.tag == 'nd':
-                way_dict = {}
-                way_dict['id'] = element.attrib['id']
-                way_dict['node_id'] = node.attrib['ref']
-                way_dict['position'] = n
-                n += 1
-                way_nodes.append(way_dict)
-            if node.tag == 'tag':
-                tag_dict = {}
-                tag_dict['id'] = element.attrib['id']
-                if ':' in node.attrib['k']:
-                    tag_dict['type'] = node.attrib['k'].split(':', 1)[0]
-                    tag_dict['key'] = node.attrib['k'].split(':', 1)[-1]
-                    tag_dict['value'] = node.attrib['v'].split(':', 1)[0]
-                else:
-                    tag_dict['type'] = 'regular'
-                    tag_dict['key'] = node.attrib['k']
-                    tag_dict['value'] = node.attrib['v']
-                tags.append(tag_dict)
-
-    if element.tag == 'node':
-        return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
-
-
-# ================================================== #
-#               Helper Functions                     #
-# ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-def validate_element(element, validator, schema=SCHEMA):
-    """Raise ValidationError if element does not match schema"""
-    if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
-        
-        raise Exception(message_string.format(field, error_string))
-
-
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
-
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
-
-# ================================================== #
-#               Main Function                        #
-# ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-
-
-if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=True)
-    
-    import sqlite3
+INSERT_NODES = "INSERT INTO nodes(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);"
+INSERT_NODES_TAGS = "INSERT INTO nodes_tags(id, key, value, type) VALUES (?, ?, ?, ?);"
+INSERT_WAYS = "INSERT INTO ways(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);"
+INSERT_WAYS_TAGS = "INSERT INTO ways_tags(id, key, value, type) VALUES (?, ?, ?, ?);"
+INSERT_WAYS_NODES = "INSERT INTO ways_nodes(id, node_id, position) VALUES (?, ?, ?);"
 
-# Creating database on disk
-sqlite_file = 'nashville.db'
-conn = sqlite3.connect(sqlite_file)
-conn.text_factory = str
-c = conn.cursor()
+# Rows are buffered and handed to executemany() this many at a time
+BATCH_SIZE = 10000
 
-c.execute('''DROP TABLE IF EXISTS nodes''')
-c.execute('''DROP TABLE IF EXISTS nodes_tags''')
-c.execute('''DROP TABLE IF EXISTS ways''')
-c.execute('''DROP TABLE IF EXISTS ways_tags''')
-c.execute('''DROP TABLE IF EXISTS ways_nodes''')
-conn.commit()
+# Start of a top-level element; OSM escapes '<' in attribute values, so this only matches real tags
+TOP_LEVEL_RE = re.compile(rb'<(?:node|way|relation)[\s/>]')
+# Bytes read at a time when finding and reading shards for the parallel audit
+SHARD_READ_SIZE = 1024 * 1024
+# Bytes of XML per shard; fixed so a shard's rows stay the same size however large the file is
+SHARD_SIZE = 2 * 1024 * 1024
 
 QUERY_NODES = """
 CREATE TABLE nodes (
@@ -424,125 +283,476 @@ CREATE TABLE ways_nodes (
 );
 """
 
+QUERY_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_ways_tags_key_type ON ways_tags(key, type);
+CREATE INDEX IF NOT EXISTS idx_nodes_tags_key ON nodes_tags(key);
+CREATE INDEX IF NOT EXISTS idx_ways_nodes_id ON ways_nodes(id);
+ANALYZE;
+"""
 
+def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape node or way XML element to csv rows (tuples in *_FIELDS order)"""
 
-c.execute(QUERY_NODES)
-c.execute(QUERY_NODES_TAGS)
-c.execute(QUERY_WAYS)
-c.execute(QUERY_WAYS_TAGS)
-c.execute(QUERY_WAYS_NODES)
+    attrib = element.attrib
+    el_id = int(attrib['id'])  # numeric fields are coerced here, not per row by cerberus
+    way_nodes = []
+    tags = []  # Handle secondary tags the same way for both node and way elements
 
-conn.commit()
+    if element.tag == 'node':
+        # Users, tag keys and tag types repeat across millions of rows; intern them so
+        # every row shares one string object per distinct value
+        node_row = (el_id, float(attrib['lat']), float(attrib['lon']), intern(attrib['user']), int(attrib['uid']),
+                    attrib['version'], int(attrib['changeset']), attrib['timestamp'])
 
-with open('nodes.csv','rt') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db1 = [(i['id'], i['lat'], i['lon'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-    
-with open('nodes_tags.csv','rt') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db2 = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-    
-with open('ways.csv','rt') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db3 = [(i['id'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-    
-with open('ways_tags.csv','rt') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db4 = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-    
-with open('ways_nodes.csv','rt') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db5 = [(i['id'], i['node_id'], i['position']) for i in dr]
-    
-c.executemany("INSERT INTO nodes(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", to_db1)
-c.executemany("INSERT INTO nodes_tags(id, key, value, type) VALUES (?, ?, ?, ?);", to_db2)
-c.executemany("INSERT INTO ways(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);", to_db3)
-c.executemany("INSERT INTO ways_tags(id, key, value, type) VALUES (?, ?, ?, ?);", to_db4)
-c.executemany("INSERT INTO ways_nodes(id, node_id, position) VALUES (?, ?, ?);", to_db5)
-conn.commit()
-
-c.execute('SELECT COUNT(*) FROM nodes')
-all_rows = c.fetchall()
-print(all_rows)
-
-c.execute('SELECT COUNT(*) FROM ways')
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT ways_tags.value, COUNT(*)
-FROM ways_tags
-WHERE ways_tags.key = 'name'
-AND ways_tags.type = 'regular'
-GROUP BY ways_tags.value
-ORDER BY COUNT(*) DESC
-LIMIT 10;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT AVG(Count)
-FROM
-    (SELECT COUNT(*) as Count
-    FROM ways
-    JOIN ways_nodes
-    ON ways.id = ways_nodes.id
-    GROUP BY ways.id);
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT value, COUNT(*) as Count
-FROM nodes_tags
-WHERE key='amenity'
-GROUP BY value
-ORDER BY Count DESC
-LIMIT 10;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT COUNT(*) FROM nodes;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT COUNT(*) FROM ways;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT COUNT(DISTINCT(e.uid))
-FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
-
-QUERY = '''
-SELECT e.user, COUNT(*) as num
-FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
-GROUP BY e.user
-ORDER BY num DESC
-LIMIT 10;
-'''
-
-c.execute(QUERY)
-all_rows = c.fetchall()
-print(all_rows)
+        for node in element:
+            k = node.attrib['k']
+            v = node.attrib['v']
+            head, sep, tail = k.partition(':')
+            if sep:
+                tags.append((el_id, intern(tail), v.partition(':')[0], intern(head)))
+            else:
+                tags.append((el_id, intern(k), v, default_tag_type))
+
+        return ('node', node_row, tags)
+
+    elif element.tag == 'way':
+        way_row = (el_id, intern(attrib['user']), int(attrib['uid']), attrib['version'],
+                   int(attrib['changeset']), attrib['timestamp'])
+        for n, nd in enumerate(element.iterfind('nd')):
+            way_nodes.append((el_id, int(nd.attrib['ref']), n))
+        for node in element.iterfind('tag'):
+            k = node.attrib['k']
+            v = node.attrib['v']
+            head, sep, tail = k.partition(':')
+            if sep:
+                tags.append((el_id, intern(tail), v.partition(':')[0], intern(head)))
+            else:
+                tags.append((el_id, intern(k), v, default_tag_type))
+
+        return ('way', way_row, way_nodes, tags)
+
+
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def open_csv(path):
+    """Open a csv for writing with a large write buffer"""
+    return open(path, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFERING)
+
+
+def validate_element(element, validator, schema=None):
+    """Raise ValidationError if element does not match schema (defaults to the validator's own)"""
+    if element[0] == 'node':
+        document = {'node': dict(zip(NODE_FIELDS, element[1])),
+                    'node_tags': [dict(zip(NODE_TAGS_FIELDS, row)) for row in element[2]]}
+    else:
+        document = {'way': dict(zip(WAY_FIELDS, element[1])),
+                    'way_nodes': [dict(zip(WAY_NODES_FIELDS, row)) for row in element[2]],
+                    'way_tags': [dict(zip(WAY_TAGS_FIELDS, row)) for row in element[3]]}
+
+    if validator.validate(document, schema, normalize=False) is not True:
+        field, errors = next(iter(validator.errors.items()))
+        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+        error_string = pprint.pformat(errors)
+        
+        raise Exception(message_string.format(field, error_string))
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def flush_rows(cursor, query, rows, writer=None):
+    """Insert the buffered rows (and write them to csv if asked) and empty the buffer"""
+    cursor.executemany(query, rows)
+    if writer is not None:
+        writer.writerows(rows)
+    rows.clear()
+
+
+def new_audit():
+    """Empty audit counters, filled in by audit_element()"""
+    return {'tag_counts': defaultdict(int),
+            'keys': {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0},
+            'problem_keys': [],
+            'street_types': defaultdict(int),
+            'street_names': [],
+            'problem_names': []}
+
+
+def audit_element(elem, audit):
+    """Count a top-level element and audit its children (<tag />, <nd />, <member />)"""
+    tag_counts = audit['tag_counts']
+    tag_counts[elem.tag] += 1
+
+    for child in elem:
+        tag_counts[child.tag] += 1
+        if child.tag == 'tag':
+            a = child.attrib
+            k = a['k']
+            audit['keys'][classify_key(k)] += 1
+            if not _PROBLEM.isdisjoint(k):
+                audit['problem_keys'].append(k)
+            if k == "addr:street":
+                street_name = a['v']
+                audit_street_type(audit['street_types'], street_name)
+                audit['street_names'].append(street_name)
+                if not _NAME_PROBLEM.isdisjoint(street_name):
+                    audit['problem_names'].append(street_name)
+
+
+def merge_audit(audit, part):
+    """Add the counters of another (partial) audit into audit"""
+    for name in ('tag_counts', 'keys', 'street_types'):
+        for k, v in part[name].items():
+            audit[name][k] += v
+    for name in ('problem_keys', 'street_names', 'problem_names'):
+        audit[name].extend(part[name])
+
+
+def finish_audit(audit):
+    """Judge street name typos against the final street type counts and return the results"""
+    typo_full_names = defaultdict(list)
+    # Typos can only be judged once every street type has been counted
+    for street_name in audit['street_names']:
+        audit_street_name(typo_full_names, audit['street_types'], street_name)
+
+    return {'tag_counts': dict(audit['tag_counts']), 'keys': audit['keys'],
+            'problem_keys': audit['problem_keys'], 'street_types': audit['street_types'],
+            'typo_full_names': typo_full_names, 'problem_names': audit['problem_names']}
+
+
+def audit_all(file_in, conn, validate, dump_csv=False):
+    """Audit tags and street names and load the database in a single pass over the XML"""
+
+    audit = new_audit()
+
+    c = conn.cursor()
+    node_buf, node_tag_buf, way_buf, way_tag_buf, way_node_buf = [], [], [], [], []
+
+    with ExitStack() as stack:
+        nodes_writer = node_tags_writer = ways_writer = way_nodes_writer = way_tags_writer = None
+        if dump_csv:
+            nodes_writer = csv.writer(stack.enter_context(open_csv(NODES_PATH)))
+            node_tags_writer = csv.writer(stack.enter_context(open_csv(NODE_TAGS_PATH)))
+            ways_writer = csv.writer(stack.enter_context(open_csv(WAYS_PATH)))
+            way_nodes_writer = csv.writer(stack.enter_context(open_csv(WAY_NODES_PATH)))
+            way_tags_writer = csv.writer(stack.enter_context(open_csv(WAY_TAGS_PATH)))
+
+            nodes_writer.writerow(NODE_FIELDS)
+            node_tags_writer.writerow(NODE_TAGS_FIELDS)
+            ways_writer.writerow(WAY_FIELDS)
+            way_nodes_writer.writerow(WAY_NODES_FIELDS)
+            way_tags_writer.writerow(WAY_TAGS_FIELDS)
+
+        # Built once: handing the schema to every validate() call makes cerberus re-check it per element
+        validator = cerberus.Validator(SCHEMA, allow_unknown=False, purge_unknown=False)
+
+        # Children (<tag />, <nd />, <member />) are walked from their parent
+        # rather than surfacing as iterparse events of their own
+        context = ET.iterparse(file_in, events=('end',),
+                               tag=('note', 'meta', 'bounds', 'node', 'way', 'relation'))
+        for _, elem in context:
+            audit_element(elem, audit)
+
+            if elem.tag in ('node', 'way'):
+                el = shape_element(elem)
+                if validate is True:
+                    validate_element(el, validator)
+
+                if el[0] == 'node':
+                    node_buf.append(el[1])
+                    node_tag_buf.extend(el[2])
+                    if len(node_buf) >= BATCH_SIZE:
+                        flush_rows(c, INSERT_NODES, node_buf, nodes_writer)
+                    if len(node_tag_buf) >= BATCH_SIZE:
+                        flush_rows(c, INSERT_NODES_TAGS, node_tag_buf, node_tags_writer)
+                else:
+                    way_buf.append(el[1])
+                    way_node_buf.extend(el[2])
+                    way_tag_buf.extend(el[3])
+                    if len(way_buf) >= BATCH_SIZE:
+                        flush_rows(c, INSERT_WAYS, way_buf, ways_writer)
+                    if len(way_node_buf) >= BATCH_SIZE:
+                        flush_rows(c, INSERT_WAYS_NODES, way_node_buf, way_nodes_writer)
+                    if len(way_tag_buf) >= BATCH_SIZE:
+                        flush_rows(c, INSERT_WAYS_TAGS, way_tag_buf, way_tags_writer)
+
+            clear_element(elem)
+
+        audit['tag_counts'][context.root.tag] += 1
+
+        flush_rows(c, INSERT_NODES, node_buf, nodes_writer)
+        flush_rows(c, INSERT_NODES_TAGS, node_tag_buf, node_tags_writer)
+        flush_rows(c, INSERT_WAYS, way_buf, ways_writer)
+        flush_rows(c, INSERT_WAYS_NODES, way_node_buf, way_nodes_writer)
+        flush_rows(c, INSERT_WAYS_TAGS, way_tag_buf, way_tags_writer)
+    conn.commit()
+
+    return finish_audit(audit)
+
+
+# ================================================== #
+#               Parallel Audit                       #
+# ================================================== #
+def next_element_offset(f, pos, end):
+    """Return the offset of the first top-level element starting at or after pos (end if there is none)"""
+    while pos < end:
+        f.seek(pos)
+        # Overlap the windows so a start tag split across two of them is still found
+        window = f.read(SHARD_READ_SIZE + 16)
+        m = TOP_LEVEL_RE.search(window)
+        if m:
+            return min(pos + m.start(), end)
+        pos += SHARD_READ_SIZE
+    return end
+
+
+def find_shards(file_in, shard_size=SHARD_SIZE):
+    """
+    Split the OSM file into byte ranges of about `shard_size` bytes, each holding a run of
+    whole top-level elements (<node />, <way />, <relation />).
+    Returns the header (everything before the first of those elements) and the ranges.
+    """
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as f:
+        f.seek(max(size - SHARD_READ_SIZE, 0))
+        tail = f.read()
+        close = tail.rfind(b'</osm>')
+        if close < 0:
+            raise ValueError("{0} has no closing </osm> tag; is the file truncated?".format(file_in))
+        data_end = size - len(tail) + close
+
+        first = next_element_offset(f, 0, data_end)
+        f.seek(0)
+        header = f.read(first)
+
+        bounds = [first]
+        while bounds[-1] < data_end:
+            bounds.append(next_element_offset(f, bounds[-1] + shard_size, data_end))
+
+    return header, list(zip(bounds, bounds[1:]))
+
+
+def read_shard(file_in, start, end):
+    """Yield the bytes of a shard in chunks, wrapped in an <osm> element so it parses on its own"""
+    yield b'<osm>'
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(SHARD_READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    yield b'</osm>'
+
+
+def audit_shard(shard):
+    """Audit and shape the top-level elements of one shard (runs in a worker process)"""
+    file_in, start, end, validate = shard
+
+    audit = new_audit()
+    rows = {'nodes': [], 'nodes_tags': [], 'ways': [], 'ways_nodes': [], 'ways_tags': []}
+    validator = cerberus.Validator(SCHEMA, allow_unknown=False, purge_unknown=False)
+
+    parser = ET.XMLPullParser(events=('end',), tag=('node', 'way', 'relation'))
+    for chunk in read_shard(file_in, start, end):
+        parser.feed(chunk)
+        for _, elem in parser.read_events():
+            audit_element(elem, audit)
+
+            if elem.tag in ('node', 'way'):
+                el = shape_element(elem)
+                if validate is True:
+                    validate_element(el, validator)
+
+                if el[0] == 'node':
+                    rows['nodes'].append(el[1])
+                    rows['nodes_tags'].extend(el[2])
+                else:
+                    rows['ways'].append(el[1])
+                    rows['ways_nodes'].extend(el[2])
+                    rows['ways_tags'].extend(el[3])
+
+            clear_element(elem)
+    parser.close()
+
+    return audit, rows
+
+
+def load_shard(cursor, audit, result):
+    """Merge one shard's audit into audit and insert its rows"""
+    part, rows = result
+    merge_audit(audit, part)
+    cursor.executemany(INSERT_NODES, rows['nodes'])
+    cursor.executemany(INSERT_NODES_TAGS, rows['nodes_tags'])
+    cursor.executemany(INSERT_WAYS, rows['ways'])
+    cursor.executemany(INSERT_WAYS_NODES, rows['ways_nodes'])
+    cursor.executemany(INSERT_WAYS_TAGS, rows['ways_tags'])
+
+
+def audit_all_parallel(file_in, conn, validate, processes=None):
+    """
+    Same audit and database load as audit_all(), with the XML parsing, auditing and
+    shaping spread over worker processes. Rows come back to this process, the only
+    writer to the database. Does not write the csv(s).
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        # A single worker only adds pickling and process overhead to the serial pass
+        return audit_all(file_in, conn, validate)
+
+    header, shards = find_shards(file_in)
+
+    audit = new_audit()
+    for elem in ET.fromstring(header + b'</osm>').iter():
+        audit['tag_counts'][elem.tag] += 1
+
+    c = conn.cursor()
+    pending = deque()
+    with multiprocessing.Pool(processes) as pool:
+        for start, end in shards:
+            pending.append(pool.apply_async(audit_shard, ((file_in, start, end, validate),)))
+            # Bound the shards parsed but not yet loaded; results are taken in
+            # submission order so the audit lists stay in document order
+            if len(pending) > processes:
+                load_shard(c, audit, pending.popleft().get())
+        while pending:
+            load_shard(c, audit, pending.popleft().get())
+    conn.commit()
+
+    return finish_audit(audit)
+
+
+def main():
+    # Creating database on disk
+    sqlite_file = 'nashville.db'
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    c = conn.cursor()
+
+    c.execute('''DROP TABLE IF EXISTS nodes''')
+    c.execute('''DROP TABLE IF EXISTS nodes_tags''')
+    c.execute('''DROP TABLE IF EXISTS ways''')
+    c.execute('''DROP TABLE IF EXISTS ways_tags''')
+    c.execute('''DROP TABLE IF EXISTS ways_nodes''')
+    conn.commit()
+
+    c.execute(QUERY_NODES)
+    c.execute(QUERY_NODES_TAGS)
+    c.execute(QUERY_WAYS)
+    c.execute(QUERY_WAYS_TAGS)
+    c.execute(QUERY_WAYS_NODES)
+
+    conn.commit()
+
+    # The bulk load is rebuilt from map.osm on every run, so durability is not needed
+    c.execute('PRAGMA synchronous=OFF')
+    c.execute('PRAGMA journal_mode=MEMORY')
+    c.execute('BEGIN')
+
+    # Note: Validation is ~ 10X slower. For the project consider using a small
+    # sample of the map when validating.
+    results = audit_all(OSM_PATH, conn, validate=True)
+    print(results['tag_counts'])
+    print(results['keys'])
+    print(results['problem_keys'])
+    print(results['street_types'])
+    print(results['problem_names'])
+
+    # Indexes are built once the bulk load is done, far cheaper than keeping them up to date during it
+    c.execute('PRAGMA cache_size=-200000')  # ~200 MB page cache
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.executescript(QUERY_INDEXES)
+
+    c.execute('SELECT COUNT(*) FROM nodes')
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    c.execute('SELECT COUNT(*) FROM ways')
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT ways_tags.value, COUNT(*)
+    FROM ways_tags
+    WHERE ways_tags.key = 'name'
+    AND ways_tags.type = 'regular'
+    GROUP BY ways_tags.value
+    ORDER BY COUNT(*) DESC
+    LIMIT 10;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT AVG(Count)
+    FROM
+        (SELECT COUNT(*) as Count
+        FROM ways
+        JOIN ways_nodes
+        ON ways.id = ways_nodes.id
+        GROUP BY ways.id);
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT value, COUNT(*) as Count
+    FROM nodes_tags
+    WHERE key='amenity'
+    GROUP BY value
+    ORDER BY Count DESC
+    LIMIT 10;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT COUNT(*) FROM nodes;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT COUNT(*) FROM ways;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT COUNT(DISTINCT(e.uid))
+    FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+    QUERY = '''
+    SELECT e.user, COUNT(*) as num
+    FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
+    GROUP BY e.user
+    ORDER BY num DESC
+    LIMIT 10;
+    '''
+
+    c.execute(QUERY)
+    all_rows = c.fetchall()
+    print(all_rows)
+
+
+if __name__ == '__main__':
+    main()